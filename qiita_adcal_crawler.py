@@ -1,19 +1,71 @@
-import csv
 import datetime
+import io
+import logging
+import threading
 import time
-import traceback
 import typing
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from http import HTTPStatus
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Iterable, Set, Tuple
 from urllib.parse import urljoin
 
 import click
-import requests
-from bs4 import BeautifulSoup
+import requests_cache
+import soupsieve
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util import make_headers
+
+logger = logging.getLogger(__name__)
 
 WAIT_SEC = 1
+BUFFER_SIZE = 1 << 20
+MAX_WORKERS = 4
+TIMEOUT_SEC = 30
+USER_AGENT = 'qiita-adcal-crawler'
+CACHE_NAME = 'qiita_cache'
+CACHE_EXPIRE = datetime.timedelta(hours=1)
+COMPLETED_CACHE_EXPIRE = datetime.timedelta(days=7)
+
+_SEL_CAL_ROW = soupsieve.compile('.adventCalendarList tbody tr')
+_SEL_CAL_TITLE = soupsieve.compile('.adventCalendarList_calendarTitle > a')
+_SEL_CATEGORY = soupsieve.compile('.adventCalendarSection_info a')
+_SEL_AUTHOR = soupsieve.compile('.adventCalendarCalendar_author a')
+
+
+def _strain(*classes: str, tags: Tuple[str, ...] = ()) -> SoupStrainer:
+    # Keeps the given tags, elements with any of the given classes and the
+    # rel=next pagination link; the rest of the page is never built.
+    classes = set(classes)
+
+    def values(attrs, key):
+        # Depending on the tree builder, class and rel arrive here either as
+        # the raw attribute string or already split into a list.
+        value = attrs.get(key, '')
+        return value.split() if isinstance(value, str) else value
+
+    def match(name, attrs=None):
+        # beautifulsoup4 4.13+ passes only the tag name, which is not enough
+        # to filter on, so the whole page is kept there.
+        if attrs is None:
+            return True
+        return (name in tags
+                or not classes.isdisjoint(values(attrs, 'class'))
+                or (name == 'a' and 'next' in values(attrs, 'rel')))
+
+    return SoupStrainer(match)
+
+
+_STRAIN_CALENDAR_LIST = _strain('adventCalendarList')
+_STRAIN_CALENDAR = _strain('adventCalendarSection_info',
+                           'adventCalendarJumbotron_stats',
+                           'adventCalendarCalendar_day',
+                           tags=('h1',))
+_STRAIN_CALENDAR_DAYS = _strain('adventCalendarCalendar_day')
+_STRAIN_LIKERS = _strain('GridList__user')
 
 
 class HttpException(Exception):
@@ -22,6 +74,15 @@ class HttpException(Exception):
         self.status_code = status_code
 
 
+class CrawlExecutor(ThreadPoolExecutor):
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # On failure, cancel the calendars still queued instead of crawling
+        # all of them before the error is reported.
+        self.shutdown(cancel_futures=exc_type is not None)
+        return False
+
+
 Calendar = typing.NamedTuple('Calendar', [('year', int),
                                           ('calendar_id', str),
                                           ('title', str),
@@ -50,12 +111,29 @@ Liker = typing.NamedTuple('Liker', [('year', int),
 class CalendarCrawler:
 
     site = 'https://qiita.com/'
+    origin = 'https://qiita.com'
     calendars_url = 'https://qiita.com/advent-calendar/{year}/calendars'
     categories_url = 'https://qiita.com/advent-calendar/{year}/categories/{category}'
     calendar_url = 'https://qiita.com/advent-calendar/{year}/{calendar_id}'
 
-    def __init__(self):
+    def __init__(self, expire_after: datetime.timedelta = CACHE_EXPIRE):
         self.request_count = 0
+        self.lock = threading.Lock()
+        self.last_request_time = 0.0
+        self.failed_calendar_ids = set()
+
+        self.session = requests_cache.CachedSession(CACHE_NAME,
+                                                    backend='sqlite',
+                                                    expire_after=expire_after)
+        # Everything is fetched from qiita.com, so a single pool with one
+        # connection per worker is enough to keep every connection alive.
+        self.session.mount('https://', HTTPAdapter(pool_connections=1,
+                                                   pool_maxsize=MAX_WORKERS,
+                                                   pool_block=True))
+        self.session.headers.update({'User-Agent': USER_AGENT,
+                                     'Connection': 'keep-alive'})
+        # Advertises br only when brotli is installed and urllib3 can decode it.
+        self.session.headers.update(make_headers(accept_encoding=True))
 
     def crawl_calendars(self,
                         year: int,
@@ -66,32 +144,33 @@ class CalendarCrawler:
         else:
             url = self.calendars_url.format(year=year)
 
-        for soup in self.iterate_pagination(url):
+        for soup in self.iterate_pagination(url, _STRAIN_CALENDAR_LIST):
 
-            for tr in soup.select('.adventCalendarList tbody tr'):
-                title_link = tr.select_one('.adventCalendarList_calendarTitle > a')
+            for tr in _SEL_CAL_ROW.select(soup):
+                title_link = _SEL_CAL_TITLE.select_one(tr)
                 title = title_link.text
-                url = urljoin(self.site, title_link['href'])
-                calendar_id = Path(url).parts[-1]
+                url = self.absolute_url(title_link['href'])
+                calendar_id = url.rstrip('/').rsplit('/', 1)[-1]
 
                 yield calendar_id, title, url,
 
-    def crawl_calendar(self, year: int, calendar_id: str) -> Tuple[Calendar, List[Item]]:
+    def crawl_calendar(self, year: int, calendar_id: str) -> Tuple[Calendar, Iterable[Item]]:
 
         url = self.calendar_url.format(year=year,
                                        calendar_id=calendar_id)
 
-        soup = self.get_page(url)
+        soup = self.get_page(url, _STRAIN_CALENDAR)
 
         title = soup.h1.text
 
-        category = soup.select_one('.adventCalendarSection_info a').text
+        category = _SEL_CATEGORY.select_one(soup).text
 
-        participants_count = int(soup.select('.adventCalendarJumbotron_stats')[0].text)
-        likes_count = int(soup.select('.adventCalendarJumbotron_stats')[1].text)
-        subscribers_count = int(soup.select('.adventCalendarJumbotron_stats')[2].text)
+        stats = soup.find_all(class_='adventCalendarJumbotron_stats', limit=3)
+        participants_count = int(stats[0].get_text(strip=True))
+        likes_count = int(stats[1].get_text(strip=True))
+        subscribers_count = int(stats[2].get_text(strip=True))
 
-        items = list(self.parse_calendar_items(year, calendar_id, soup))
+        items = self.parse_calendar_items(year, calendar_id, soup)
 
         return (Calendar(year,
                          calendar_id,
@@ -103,80 +182,195 @@ class CalendarCrawler:
                          subscribers_count),
                 items,)
 
+    def crawl_items(self, year: int, calendar_id: str) -> Iterable[Item]:
+
+        url = self.calendar_url.format(year=year,
+                                       calendar_id=calendar_id)
+
+        soup = self.get_page(url, _STRAIN_CALENDAR_DAYS)
+
+        return self.parse_calendar_items(year, calendar_id, soup)
+
     def parse_calendar_items(self,
                              year: int,
                              calendar_id: str,
                              soup: BeautifulSoup) -> Iterable[Item]:
 
-        for td in soup.select('.adventCalendarCalendar_day'):
+        for td in soup.find_all(class_='adventCalendarCalendar_day'):
 
-            date = int(td.select_one('.adventCalendarCalendar_date').text)
+            date = int(td.find(class_='adventCalendarCalendar_date').get_text(strip=True))
 
             user_name, user_url = None, None
-            user_link = td.select_one('.adventCalendarCalendar_author a')
+            user_link = _SEL_AUTHOR.select_one(td)
             if user_link:
                 user_name = user_link.text.strip()
-                user_url = urljoin(self.site, user_link['href'])
+                user_url = self.absolute_url(user_link['href'])
 
             item_title, item_url = None, None
-            comment_div = td.select_one('.adventCalendarCalendar_comment')
+            comment_div = td.find(class_='adventCalendarCalendar_comment')
             if comment_div:
                 item_title = comment_div.text
-                item_link = comment_div.select_one('a')
+                item_link = comment_div.a
                 item_url = item_link['href'] if item_link else None
 
             yield Item(year, calendar_id, date, user_name, user_url, item_title, item_url)
 
     def crawl_likers(self, year, calendar_id) -> Iterable[Liker]:
 
-        calendar, items = self.crawl_calendar(year, calendar_id)
+        site = self.site
 
-        for item in items:
+        for item in self.crawl_items(year, calendar_id):
 
-            if not self.is_qiita_item(item.url):
+            # Only public Qiita items have a likers page.
+            if not item.url or not item.url.startswith(site) or '/private/' in item.url:
                 continue
 
             likers_url = item.url + '/likers'
 
             try:
-                for soup in self.iterate_pagination(likers_url):
+                for soup in self.iterate_pagination(likers_url, _STRAIN_LIKERS):
 
-                    for user_el in soup.select('.GridList__user'):
-                        user_name = user_el.select_one('.UserInfo__name').text
-                        user_url = urljoin(self.site, user_el.a['href'])
+                    for user_el in soup.find_all(class_='GridList__user'):
+                        user_name = user_el.find(class_='UserInfo__name').text
+                        user_url = self.absolute_url(user_el.a['href'])
                         yield Liker(year, calendar_id, item.date, user_name, user_url)
             except Exception:
-                traceback.extract_stack()
+                logger.warning('likers fetch failed for %s', likers_url, exc_info=True)
+                self.failed_calendar_ids.add(calendar_id)
+
+    def get_page(self, url: str, parse_only: SoupStrainer = None) -> BeautifulSoup:
 
-    def get_page(self, url: str) -> BeautifulSoup:
+        # Pages still fresh in the cache are served without touching the
+        # network, so they don't have to wait for the rate limit either.
+        response = self.session.get(url, only_if_cached=True)
+        if response.status_code == HTTPStatus.GATEWAY_TIMEOUT:
 
-        self.request_count += 1
+            # Requests are started at most once per WAIT_SEC, but the response
+            # and parsing of one page overlap with the wait for the next.
+            with self.lock:
+                self.request_count += 1
+                wait = WAIT_SEC - (time.monotonic() - self.last_request_time)
+                if wait > 0:
+                    time.sleep(wait)
+                self.last_request_time = time.monotonic()
 
-        time.sleep(WAIT_SEC)
+            response = self.session.get(url, timeout=TIMEOUT_SEC)
 
-        response = requests.get(url)
         if response.status_code != HTTPStatus.OK:
             raise HttpException(response.status_code)
 
-        soup = BeautifulSoup(response.content, 'html.parser')
+        # Hand the raw bytes to the parser; response.text would decode the
+        # whole body in Python first.
+        soup = BeautifulSoup(response.content, 'lxml', parse_only=parse_only)
 
         return soup
 
-    def iterate_pagination(self, url: str) -> Iterable[BeautifulSoup]:
+    def iterate_pagination(self,
+                           url: str,
+                           parse_only: SoupStrainer = None) -> Iterable[BeautifulSoup]:
 
         next_url = url
 
         while next_url:
 
-            soup = self.get_page(next_url)
+            soup = self.get_page(next_url, parse_only)
 
             yield soup
 
-            next_link = soup.select_one('a[rel=next]')
-            next_url = urljoin(self.site, next_link['href']) if next_link else None
+            next_link = soup.find('a', rel='next')
+            next_url = self.absolute_url(next_link['href']) if next_link else None
+
+    def absolute_url(self, href: str) -> str:
+        # Links on Qiita are almost always absolute or root-relative, which
+        # don't need the full urljoin parse.
+        if href.startswith(('https://', 'http://')):
+            return href
+        if href.startswith('/') and not href.startswith('//'):
+            return self.origin + href
+        return urljoin(self.site, href)
+
+
+def cache_expire_after(year: int) -> datetime.timedelta:
+    # Calendars hardly change once the last entry is out, so pages of past
+    # years can be kept much longer.
+    if datetime.date.today() > datetime.date(year, 12, 25):
+        return COMPLETED_CACHE_EXPIRE
+    return CACHE_EXPIRE
+
+
+def tsv_row(values: Iterable) -> str:
+    # Tabs and line breaks in free text such as titles are replaced rather
+    # than quoted, so every row stays on one line. Rows end in '\r\n' like
+    # the ones csv.writer wrote.
+    return '\t'.join('' if v is None else
+                     str(v).replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+                     for v in values) + '\r\n'
+
+
+def partial_path(path: Path) -> Path:
+    return path.with_name(path.name + '.part')
+
+
+def done_path(path: Path) -> Path:
+    return path.with_name(path.name + '.done')
+
+
+def drop_incomplete_line(path: Path) -> None:
+    # A killed run can leave a partly written last line behind; cut it off
+    # so appended lines start on a line of their own.
+    if not path.exists():
+        return
+
+    with path.open('rb+') as f:
+        pos = f.seek(0, io.SEEK_END)
+        while pos > 0:
+            size = min(pos, io.DEFAULT_BUFFER_SIZE)
+            pos -= size
+            f.seek(pos)
+            end = f.read(size).rfind(b'\n')
+            if end != -1:
+                f.truncate(pos + end + 1)
+                return
+        f.truncate(0)
 
-    def is_qiita_item(self, url: str) -> bool:
-        return url and url.startswith(self.site) and '/private/' not in url
+
+def completed_calendar_ids(path: Path) -> Set[str]:
+    # calendar_id is the second column of every output file.
+    if not path.exists():
+        return set()
+
+    with path.open(newline='') as f:
+        next(f, None)
+        rows = (line.rstrip('\r\n').split('\t', 2) for line in f)
+        return {row[1] for row in rows if len(row) >= 2}
+
+
+def done_calendar_ids(path: Path) -> Set[str]:
+    if not path.exists():
+        return set()
+
+    with path.open() as f:
+        return {line.rstrip('\n') for line in f if line.strip()}
+
+
+def drop_unfinished_rows(path: Path, completed_ids: Set[str]) -> None:
+    # Rows of a calendar that was cut off would be written a second time
+    # when it is crawled again, so only rows of completed calendars stay.
+    if not path.exists():
+        return
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    with path.open(newline='') as src, \
+            tmp_path.open('w', buffering=BUFFER_SIZE, newline='') as dst:
+        header = next(src, '')
+        if header.endswith('\n'):
+            dst.write(header)
+        for line in src:
+            row = line.split('\t', 2)
+            if line.endswith('\n') and len(row) >= 2 and row[1] in completed_ids:
+                dst.write(line)
+
+    tmp_path.replace(path)
 
 
 @click.command()
@@ -196,33 +390,57 @@ def crawl_calendars(output, year, category):
 
     calendars_path.parent.mkdir(parents=True, exist_ok=True)
 
-    crawler = CalendarCrawler()
-
-    calendar_ids = [
-        calendar_id
-        for calendar_id, *_ in crawler.crawl_calendars(year, category)
-    ]
-
-    calendars_file = calendars_path.open('w')
-    items_file = items_path.open('w')
-    with calendars_file, items_file:
-
-        calendars_writer = csv.writer(calendars_file, delimiter='\t')
-        calendars_writer.writerow(Calendar._fields)
-
-        items_writer = csv.writer(items_file, delimiter='\t')
-        items_writer.writerow(Item._fields)
-
-        max_len = max(map(len, calendar_ids))
-        pbar = tqdm(calendar_ids)
-        for calendar_id in pbar:
-
-            pbar.set_description_str(f'{calendar_id:{max_len}s}')
-
-            calendar, items = crawler.crawl_calendar(year, calendar_id)
-
-            calendars_writer.writerow(calendar)
-            items_writer.writerows(items)
+    crawler = CalendarCrawler(cache_expire_after(year))
+
+    try:
+        calendar_ids = [
+            calendar_id
+            for calendar_id, *_ in crawler.crawl_calendars(year, category)
+        ]
+
+        # Rows go to .part files that are flushed after every calendar, so an
+        # interrupted run resumes from the calendars already written.
+        calendars_part_path = partial_path(calendars_path)
+        items_part_path = partial_path(items_path)
+
+        drop_incomplete_line(calendars_part_path)
+        completed_ids = completed_calendar_ids(calendars_part_path)
+        drop_unfinished_rows(items_part_path, completed_ids)
+        pending_ids = [calendar_id
+                       for calendar_id in calendar_ids
+                       if calendar_id not in completed_ids]
+
+        calendars_file = calendars_part_path.open('a', buffering=BUFFER_SIZE, newline='')
+        items_file = items_part_path.open('a', buffering=BUFFER_SIZE, newline='')
+        with calendars_file, items_file, CrawlExecutor(MAX_WORKERS) as executor:
+
+            if calendars_file.tell() == 0:
+                calendars_file.write(tsv_row(Calendar._fields))
+            if items_file.tell() == 0:
+                items_file.write(tsv_row(Item._fields))
+
+            max_len = max(map(len, calendar_ids))
+            description_format = f'{{:{max_len}s}}'
+            pbar = tqdm(pending_ids, mininterval=0.5)
+            results = executor.map(partial(crawler.crawl_calendar, year),
+                                   pending_ids)
+            for calendar_id, (calendar, items) in zip(pbar, results):
+
+                pbar.set_description_str(description_format.format(calendar_id),
+                                         refresh=False)
+
+                # Parse every item before writing any, and write the calendar
+                # row last: it marks the calendar as done.
+                items = list(items)
+                items_file.writelines(tsv_row(item) for item in items)
+                calendars_file.write(tsv_row(calendar))
+                items_file.flush()
+                calendars_file.flush()
+
+        calendars_part_path.replace(calendars_path)
+        items_part_path.replace(items_path)
+    finally:
+        crawler.session.close()
 
     click.echo(datetime.datetime.now())
     click.echo(f'request count: {crawler.request_count}')
@@ -243,26 +461,60 @@ def crawl_likers(output, year, category=None):
 
     likers_path.parent.mkdir(parents=True, exist_ok=True)
 
-    crawler = CalendarCrawler()
+    crawler = CalendarCrawler(cache_expire_after(year))
+
+    try:
+        calendar_ids = [category_id
+                        for category_id, *_
+                        in crawler.crawl_calendars(year, category)]
+
+        def crawl_likers_of(calendar_id):
+            return list(crawler.crawl_likers(year, calendar_id))
+
+        # Rows go to a .part file that is flushed after every calendar, and the
+        # calendar is then recorded in a .done file, so an interrupted run
+        # resumes from the calendars completely written. Calendars where a
+        # likers page failed are not recorded and get crawled again.
+        likers_part_path = partial_path(likers_path)
+        likers_done_path = done_path(likers_path)
+
+        if not likers_part_path.exists() and likers_done_path.exists():
+            likers_done_path.unlink()
+
+        drop_incomplete_line(likers_done_path)
+        completed_ids = done_calendar_ids(likers_done_path)
+        drop_unfinished_rows(likers_part_path, completed_ids)
+        pending_ids = [calendar_id
+                       for calendar_id in calendar_ids
+                       if calendar_id not in completed_ids]
 
-    calendar_ids = [category_id
-                    for category_id, *_
-                    in crawler.crawl_calendars(year, category)]
+        f = likers_part_path.open('a', buffering=BUFFER_SIZE, newline='')
+        done_file = likers_done_path.open('a')
+        with f, done_file, CrawlExecutor(MAX_WORKERS) as executor:
 
-    with likers_path.open('w') as f:
+            if f.tell() == 0:
+                f.write(tsv_row(Liker._fields))
 
-        writer = csv.writer(f, delimiter='\t')
-        writer.writerow(Liker._fields)
+            max_len = max(map(len, calendar_ids))
+            description_format = f'{{:{max_len}s}}'
+            pbar = tqdm(pending_ids, mininterval=0.5)
+            results = executor.map(crawl_likers_of, pending_ids)
+            for calendar_id, likers in zip(pbar, results):
 
-        max_len = max(map(len, calendar_ids))
-        pbar = tqdm(calendar_ids)
-        for calendar_id in pbar:
+                pbar.set_description_str(description_format.format(calendar_id),
+                                         refresh=False)
 
-            pbar.set_description_str(f'{calendar_id:{max_len}s}')
+                f.writelines(tsv_row(liker) for liker in likers)
+                f.flush()
 
-            likers = crawler.crawl_likers(year, calendar_id)
+                if calendar_id not in crawler.failed_calendar_ids:
+                    done_file.write(calendar_id + '\n')
+                    done_file.flush()
 
-            writer.writerows(likers)
+        likers_done_path.unlink()
+        likers_part_path.replace(likers_path)
+    finally:
+        crawler.session.close()
 
     click.echo(datetime.datetime.now())
     click.echo(f'request count: {crawler.request_count}')